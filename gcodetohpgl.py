@@ -1,8 +1,6 @@
 #!/usr/bin/env python
 
 import sys
-import re
-from time import sleep
 from tempfile import SpooledTemporaryFile as sptf
 from argparse import ArgumentParser
 from glob import glob
@@ -41,10 +39,20 @@ drill_dwell = 0.7
 # number of HPGL commands to buffer before waiting
 serial_queue = 1
 
+# longest time to wait, in seconds, for the machine to answer a command
+serial_timeout = 0.1
+
 #### End machine details ####
 
 #### Start parse functions ####
 
+# last position reached by parse_move, in steps
+# TODO blindly initialising this to 0 is bad news bears.
+#       probably ought to query the machine for position, or ensure 'IN;'
+#       is run at the start of each file
+_pos_x = 0
+_pos_y = 0
+
 # HPGL SECRETS
 #
 # !OC; !RMxxx; !CC -> !RM starts spindle, !OC seems to start dangerous commands until !CC is written.
@@ -57,7 +65,7 @@ def change_units(new):
 
 def change_mode(new):
     '''Change mode on machine parameters'''
-    global mode
+    global mode, parse_move
     hpgl = ''
     if mode == new:
         return hpgl
@@ -66,56 +74,76 @@ def change_mode(new):
                '\nCO "wait for position response"\n'
     print('Changed mode from %s to %s' % (mode, new))
     mode = new
+    parse_move = parse_move_abs if new == 'abs' else parse_move_rel
     return hpgl
 
 
-def parse_move(gcode):
-    '''Parse a move command'''
-    # TODO blindly initialising this to 0 is bad news bears.
-    #       probably ought to query the machine for position, or ensure 'IN;'
-    #       is run at the start of each file
-    global mode, calfactor, xoff, yoff
-    if not hasattr(parse_move, "x"):
-        parse_move.x = 0
-    if not hasattr(parse_move, "y"):
-        parse_move.y = 0
-    xycmd = re.match(r"G0[01] X(\S*) Y(\S*).*", gcode)
-    if mode == 'abs':
-        newx = int(calfactor * (xoff + float(xycmd.group(1))))
-        newy = int(calfactor * (yoff + float(xycmd.group(2))))
-        if newx > xmax:
-            cprint('X move bigger than bed! (%d > %d) when parsing gcode=%s\n' % (newx, xmax, gcode),
-                   'red', file=sys.stderr)
-            sys.exit(12)
-        if newy > ymax:
-            cprint('Y move bigger than bed! (%d > %d)\n' % (newy, ymax),
-                   'red', file=sys.stderr)
-            sys.exit(12)
-        hpgl = 'PA%d,%d;' % (newx, newy)
-    elif mode == 'rel':
-        newx = int(calfactor * (float(xycmd.group(1))))
-        newy = int(calfactor * (float(xycmd.group(2))))
-        if parse_move.x + newx > xmax:
-            cprint('X move bigger than bed! (%d > %d)\n'
-                   % (parse_move.x + newx, xmax),
-                   'red', file=sys.stderr)
-            sys.exit(12)
-        if parse_move.y + newy > ymax:
-            cprint('Y move bigger than bed! (%d > %d)\n'
-                   % (parse_move.y + newy, ymax),
-                   'red', file=sys.stderr)
-            sys.exit(12)
-        hpgl = 'PR%d,%d;' % (parse_move.x + newx, parse_move.y + newy)
-    parse_move.x += newx
-    parse_move.y += newy
+def parse_words(gcode):
+    '''Pick the X, Y and Z words out of a GCODE line'''
+    x = y = z = None
+    for word in gcode.split()[1:]:
+        c = word[0]
+        if c == 'X':
+            x = word[1:]
+        elif c == 'Y':
+            y = word[1:]
+        elif c == 'Z':
+            z = word[1:]
+        elif c == '(':
+            # trailing comment
+            break
+    return x, y, z
+
+
+def parse_move_abs(x, y, gcode, _cf=calfactor, _xo=xoff, _yo=yoff, _xm=xmax, _ym=ymax):
+    '''Parse a move command in absolute mode'''
+    # machine configuration is bound as default arguments so the lookups
+    # below are locals rather than globals
+    global _pos_x, _pos_y
+    newx = int(_cf * (_xo + float(x)))
+    newy = int(_cf * (_yo + float(y)))
+    if newx > _xm:
+        cprint('X move bigger than bed! (%d > %d) when parsing gcode=%s\n' % (newx, _xm, gcode),
+               'red', file=sys.stderr)
+        sys.exit(12)
+    if newy > _ym:
+        cprint('Y move bigger than bed! (%d > %d)\n' % (newy, _ym),
+               'red', file=sys.stderr)
+        sys.exit(12)
+    _pos_x += newx
+    _pos_y += newy
+    return f'PA{newx},{newy};'
+
+
+def parse_move_rel(x, y, gcode, _cf=calfactor, _xm=xmax, _ym=ymax):
+    '''Parse a move command in relative mode'''
+    global _pos_x, _pos_y
+    newx = int(_cf * float(x))
+    newy = int(_cf * float(y))
+    if _pos_x + newx > _xm:
+        cprint('X move bigger than bed! (%d > %d)\n'
+               % (_pos_x + newx, _xm),
+               'red', file=sys.stderr)
+        sys.exit(12)
+    if _pos_y + newy > _ym:
+        cprint('Y move bigger than bed! (%d > %d)\n'
+               % (_pos_y + newy, _ym),
+               'red', file=sys.stderr)
+        sys.exit(12)
+    hpgl = f'PR{_pos_x + newx},{_pos_y + newy};'
+    _pos_x += newx
+    _pos_y += newy
     return hpgl
 
 
-def parse_z(gcode, drill):
+# parse_move for the current mode, rebound by change_mode
+parse_move = parse_move_abs if mode == 'abs' else parse_move_rel
+
+
+def parse_z(z, drill):
     '''Parse a Z command'''
     global drill_dwell
-    zcmd = re.match(r"G0[01] Z(\S*).*", gcode)
-    newz = float(zcmd.group(1))
+    newz = float(z)
     if newz <= 0.0:
         hpgl = 'PD;'
         if drill:
@@ -134,9 +162,8 @@ def parse_dwell(line):
 def parse_tool_change(gcode):
     '''Parse a tool-change command'''
     global drill_dwell
-    newtool = re.match(r"M06 T([0-9]*) \((.*)\).*", gcode)
-    tool = newtool.group(1).strip()
-    size = newtool.group(2).strip()
+    tool = gcode[gcode.find('T') + 1:gcode.find('(')].strip()
+    size = gcode[gcode.find('(') + 1:gcode.rfind(')')].strip()
     hpgl = 'PA0,0;\nCO "Insert tool #%s: size %s"\n' % (tool, size)
     if size not in ('routing', 'milling'):
         drill_dwell = 20 * float(size)
@@ -153,47 +180,84 @@ def parse_spindle(start):
         return '!RM0;'
         # return '!OC;!RM0;!CC;!EM0;'
 
+
+def parse_xyz(line, drill):
+    '''Parse a move of some sort'''
+    x, y, z = parse_words(line)
+    if z is not None:
+        # Z move
+        if x is not None or y is not None:
+            cprint('Combined XY and Z move is unsupported! (gcode=%s)\n'
+                   % line, 'red', file=sys.stderr)
+            sys.exit(13)
+        return parse_z(z, drill)
+    # XY move
+    return parse_move(x, y, line)
+
+
+# GCODE prefix -> handler(line, drill)
+_DISPATCH = {
+    # inch units
+    'G20': lambda line, drill: change_units('in') or '',
+    # mm units
+    'G21': lambda line, drill: change_units('mm') or '',
+    # absolute moves
+    'G90': lambda line, drill: change_mode('abs'),
+    # relative moves
+    'G91': lambda line, drill: change_mode('rel'),
+    'G00': parse_xyz,
+    'G01': parse_xyz,
+    # dwell
+    'G04': lambda line, drill: parse_dwell(line),
+    # start spindle
+    'M03': lambda line, drill: parse_spindle(start=True),
+    # stop spindle
+    'M05': lambda line, drill: parse_spindle(start=False),
+    # tool change
+    'M06': lambda line, drill: parse_tool_change(line),
+}
+
+
 def parse_line(line, drill):
     '''Parse a line of GCODE'''
-    hpgl = ''
-    if line.startswith('G20'):
-        # inch units
-        change_units('in')
-    elif line.startswith('G21'):
-        # mm units
-        change_units('mm')
-    elif line.startswith('G90'):
-        # absolute moves
-        hpgl = change_mode('abs')
-    elif line.startswith('G91'):
-        # relative moves
-        hpgl = change_mode('rel')
-    elif line.startswith('G00') or line.startswith('G01'):
-        # move of some sort
-        if 'Z' in line:
-            # Z move
-            hpgl = parse_z(line, drill)
-        else:
-            # XY move
-            hpgl = parse_move(line)
-    elif line.startswith('G04'):
-        # dwell
-        hpgl = parse_dwell(line)
-    elif line.startswith('M03'):
-        # start spindle
-        hpgl = parse_spindle(start=True)
-    elif line.startswith('M05'):
-        # stop spindle
-        hpgl = parse_spindle(start=False)
-    elif line.startswith('M06'):
-        # tool change
-        hpgl = parse_tool_change(line)
-    return hpgl
+    handler = _DISPATCH.get(line[:3])
+    if handler is None:
+        return ''
+    return handler(line, drill)
+
+
+def iter_gcode(path):
+    '''Yield the stripped lines of a GCODE file, skipping blanks and comments'''
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and line[0] != '(':
+                yield line
+
+
+def emit_file(path, drill, hpgl_file, number, pre='', verbose=False):
+    '''Convert a GCODE file to HPGL, returning the running line number'''
+    # collect the whole file's HPGL and write it out in one go
+    pieces = [pre]
+    append = pieces.append
+    for line in iter_gcode(path):
+        hpgl = parse_line(line, drill)
+        number += 1
+        if verbose:
+            print('%d\t%s\t\t%s%s' % (number, line, ('', '\t')[len(line) < 16],
+                                      hpgl.strip()))
+        append(hpgl)
+    hpgl_file.write(''.join(pieces).encode('ascii'))
+    return number
 
 #### End parse functions ####
 
 #### Start control functions ####
 
+# colour templates for the per-command log lines, built once up front
+_RED_LINE = colored('%s', 'red') + '\n'
+_WHITE_LINE = colored('%s', 'white') + '\n'
+
 
 def tool_change(hpgl):
     '''Change tools'''
@@ -201,15 +265,32 @@ def tool_change(hpgl):
     input(colored('%s\nPress enter when done.' % drill, 'cyan'))
 
 
-def send_cmd(ser, hpgl, wait=0.1):
-    '''Send a command and wait for the response from the machine'''
-    ser.write(bytes(hpgl + ";", 'ascii'))
-    sleep(wait)
-    c = ser.read(128).decode('ascii')
+def iter_commands(hpgl_file, size=65536):
+    '''Yield the HPGL commands in a file, reading it a chunk at a time'''
+    # commands end in ';', CO comments are on their own line
+    tail = b''
+    while True:
+        chunk = hpgl_file.read(size)
+        if not chunk:
+            break
+        *commands, tail = (tail + chunk).replace(b'\n', b';').split(b';')
+        for command in commands:
+            if command:
+                yield command
+    if tail:
+        yield tail
+
+
+def send_cmd(ser, hpgl):
+    '''Send one or more ;-separated commands and wait for the response from
+    the machine'''
+    ser.write(hpgl + b';')
+    # returns as soon as the reply is complete, or after serial_timeout
+    c = ser.read_until(b';', 128).decode('ascii', errors='replace')
     if 'E' in c:
-        cprint('%r\t%r' % (hpgl, c), 'red', file=sys.stderr)
+        sys.stderr.write(_RED_LINE % ('%r\t%r' % (hpgl.decode('ascii'), c)))
     else:
-        cprint('%r\t%r' % (hpgl, c), 'white', file=sys.stdout)
+        sys.stdout.write(_WHITE_LINE % ('%r\t%r' % (hpgl.decode('ascii'), c)))
 
 #### End control functions ####
 
@@ -231,6 +312,9 @@ def main():
     parser.add_argument('-f', '--file', dest='file', default='',
                         help='which file prefix to use out of the gcode'
                         ' files in the directory')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+                        default=False, help='print every GCODE line with the'
+                        ' HPGL it produced')
     ser_opts = parser.add_argument_group('serial port options')
     ser_opts.add_argument('-p', '--port', dest='port', default='/dev/ttyUSB0',
                           help='serial port (default /dev/ttyUSB0)')
@@ -244,9 +328,15 @@ def main():
     #### Start GCODE parse and HPGL generation ####
     # find the correct GCODE files
     print('%s Start GCODE Processing %s' % ('-' * 28, '-' * 28))
-    drills = glob(join(args.gcode_dir, args.file + '*drill.g'))
-    routes = glob(join(args.gcode_dir, args.file + '*etch.g'))
-    mills = glob(join(args.gcode_dir, args.file + '*mill.g'))
+    # one directory traversal, bucketed by suffix
+    drills, routes, mills = [], [], []
+    for path in glob(join(args.gcode_dir, args.file + '*.g')):
+        if path.endswith('drill.g'):
+            drills.append(path)
+        elif path.endswith('etch.g'):
+            routes.append(path)
+        elif path.endswith('mill.g'):
+            mills.append(path)
 
     if len(drills) > 1:
         sys.stderr.write('Multiple drill files selected, too confusing!\n\t')
@@ -276,89 +366,53 @@ def main():
     # determine if we need a temp file or a real one
     hpgl_file = None
     if args.save_hpgl == '$$$$TEMP$$$$':
-        hpgl_file = sptf(max_size=10000000, mode='w')
+        hpgl_file = sptf(max_size=10000000, mode='w+b')
         print('Producing HPGL output in tempfile')
     else:
-        hpgl_file = open(args.save_hpgl, 'w')
+        hpgl_file = open(args.save_hpgl, 'wb+')
         print('Producing HPGL output in %s' % args.save_hpgl)
 
-    hpgl_file.write('IN;!CT1;VS%d;!OC;!SV140;!SM32;!WR0,8,8;!CC;!CM1;'
+    hpgl_file.write(b'IN;!CT1;VS%d;!OC;!SV140;!SM32;!WR0,8,8;!CC;!CM1;'
                     % (mill_feed))
     number = 0
     # drills first
     if drills:
-        with open(drills[0]) as f:
-            print('%s Drills %s' % ('=' * 36, '=' * 36))
-            for line in f:
-                line = line.strip()
-                if line.startswith('('):
-                    # comment
-                    continue
-                hpgl = parse_line(line, drill=True)
-                number += 1
-                print()
-                '%d\t%s\t\t%s%s' % (number, line, ('', '\t')[len(line) < 16],
-                                    hpgl.strip())
-                hpgl_file.write(hpgl)
-            print('%s End Drills %s' % ('=' * 34, '=' * 34))
+        print('%s Drills %s' % ('=' * 36, '=' * 36))
+        number = emit_file(drills[0], True, hpgl_file, number,
+                           verbose=args.verbose)
+        print('%s End Drills %s' % ('=' * 34, '=' * 34))
 
     # routing on the drill layer next
     if routes:
-        with open([f for f in routes if layer in f][0]) as f:
-            print('%s %s Traces %s' % ('=' * 34, layer, '=' * 34))
-            hpgl_file.write(parse_tool_change('M06 T98 (routing )'))
-            for line in f:
-                line = line.strip()
-                if line.startswith('('):
-                    # comment
-                    continue
-                hpgl = parse_line(line, drill=False)
-                number += 1
-                print('%d\t%s\t\t%s%s' % (number, line, ('', '\t')[len(line) < 16],
-                                          hpgl.strip()))
-                hpgl_file.write(hpgl)
-            print('%s End %s Traces %s' % ('=' * 32, layer, '=' * 32))
-
-    hpgl_file.write(parse_spindle(start=False))
-    hpgl_file.write('PU;')
+        print('%s %s Traces %s' % ('=' * 34, layer, '=' * 34))
+        number = emit_file([f for f in routes if layer in f][0], False,
+                           hpgl_file, number,
+                           pre=parse_tool_change('M06 T98 (routing )'),
+                           verbose=args.verbose)
+        print('%s End %s Traces %s' % ('=' * 32, layer, '=' * 32))
+
+    hpgl_file.write(parse_spindle(start=False).encode('ascii'))
+    hpgl_file.write(b'PU;')
     # hpgl_file.write('PU;PA%d,%d;' % (xmax, 0))
-    hpgl_file.write('\nCO "Please flip board."\n')
+    hpgl_file.write(b'\nCO "Please flip board."\n')
 
     # routing on other layer
     if len(routes) > 1:
-        with open([f for f in routes if olayer in f][0]) as f:
-            print('%s %s Traces %s' % ('=' * 34, olayer, '=' * 34))
-            for line in f:
-                line = line.strip()
-                if line.startswith('('):
-                    # comment
-                    continue
-                hpgl = parse_line(line, drill=False)
-                number += 1
-                print('%d\t%s\t\t%s%s' % (number, line, ('', '\t')[len(line) < 16],
-                                          hpgl.strip()))
-                hpgl_file.write(hpgl)
-            print('%s End %s Traces %s' % ('=' * 32, olayer, '=' * 32))
+        print('%s %s Traces %s' % ('=' * 34, olayer, '=' * 34))
+        number = emit_file([f for f in routes if olayer in f][0], False,
+                           hpgl_file, number, verbose=args.verbose)
+        print('%s End %s Traces %s' % ('=' * 32, olayer, '=' * 32))
 
     # milling layer last
     mills = [f for f in mills if olayer in f]
     if mills:
-        with open(mills[0]) as f:
-            hpgl_file.write(parse_tool_change('M06 T99 (milling )'))
-            print('%s %s Traces %s' % ('=' * 34, layer, '=' * 34))
-            for line in f:
-                line = line.strip()
-                if line.startswith('('):
-                    # comment
-                    continue
-                hpgl = parse_line(line, drill=False)
-                number += 1
-                print('%d\t%s\t\t%s%s' % (number, line, ('', '\t')[len(line) < 16],
-                                          hpgl.strip()))
-                hpgl_file.write(hpgl)
-            print('%s End %s Traces %s' % ('=' * 32, layer, '=' * 32))
-
-    hpgl_file.write('!OC;!RM0;!CC;PU;')
+        print('%s %s Traces %s' % ('=' * 34, layer, '=' * 34))
+        number = emit_file(mills[0], False, hpgl_file, number,
+                           pre=parse_tool_change('M06 T99 (milling )'),
+                           verbose=args.verbose)
+        print('%s End %s Traces %s' % ('=' * 32, layer, '=' * 32))
+
+    hpgl_file.write(b'!OC;!RM0;!CC;PU;')
     # hpgl_file.write('!OC;!RM0;!CC;PU;!EM0;PA%d,%d;' % (xmax, 0))
 
     print('%s End GCODE Processing %s' % ('-' * 29, '-' * 29))
@@ -371,7 +425,10 @@ def main():
 
         class SerialDummy():
             def read(self, count):
-                return ''
+                return b''
+
+            def read_until(self, expected, size):
+                return b''
 
             def inWaiting(self):
                 return 0
@@ -381,24 +438,32 @@ def main():
 
         ser = SerialDummy()
     else:
-        ser = serial.Serial(args.port, args.baud, timeout=0.01)
+        ser = serial.Serial(args.port, args.baud, timeout=serial_timeout)
 
     # discard anything in the input buffer before starting
     ser.read(ser.inWaiting())
 
+    # commands waiting to be sent, up to serial_queue at a time
+    queue = []
     hpgl_file.seek(0, 0)
-    for line in hpgl_file.read().split('\n'):
-        print(colored(repr(line.strip()), 'green'))
-        for command in line.split(";"):
-            if command:
-                if command.startswith('CO'):
-                    if 'tool' in command:
-                        tool_change(command)
-                    elif 'flip' in command:
-                        input(colored('Please flip board.\nPress Enter'
-                                      ' when ready.', 'cyan'))
-                else:
-                    send_cmd(ser, command)
+    for command in iter_commands(hpgl_file):
+        if command.startswith(b'CO'):
+            # everything before a pause must reach the machine first
+            if queue:
+                send_cmd(ser, b';'.join(queue))
+                queue = []
+            if b'tool' in command:
+                tool_change(command.decode('ascii'))
+            elif b'flip' in command:
+                input(colored('Please flip board.\nPress Enter'
+                              ' when ready.', 'cyan'))
+        else:
+            queue.append(command)
+            if len(queue) >= serial_queue:
+                send_cmd(ser, b';'.join(queue))
+                queue = []
+    if queue:
+        send_cmd(ser, b';'.join(queue))
     input(colored('Wait until plotter finishes and press enter to'
                       ' exit', 'cyan'))
     print('%s End RS-232 Control %s' % ('-' * 30, '-' * 30))